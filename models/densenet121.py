@@ -242,7 +242,7 @@ class _DenseNet121_():
         self.model.features.load_state_dict(adjusted_feature_weights)
 
             # trainable feature layers
-        if self.trainable_feature_layers==None:
+        if self.trainable_feature_layers is None:
             self.freeze = self.model.features
         else:
             len_ = len(self.model.features) #11
@@ -77,7 +77,7 @@ class ResNet():
         # LAYERS TO FREEZE DURING TRAINING
         all_layers = [self.model.conv1, self.model.bn1, self.model.relu, self.model.maxpool,
                     self.model.layer1, self.model.layer2, self.model.layer3, self.model.layer4]
-        if self.trainable_layers==None:
+        if self.trainable_layers is None:
             self.freeze = all_layers
         else: 
             assert all(x in range(len(all_layers)) for x in self.trainable_layers)
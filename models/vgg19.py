@@ -39,7 +39,7 @@ class VGG19():
         ))
 
         # LAYERS TO FREEZE DURING TRAINING
-        if self.trainable_feature_layers==None:
+        if self.trainable_feature_layers is None:
             self.freeze = self.model.features
         else: 
             assert all(x in range(len(self.model.features)) for x in self.trainable_feature_layers)
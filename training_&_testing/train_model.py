@@ -1,11 +1,12 @@
+import torch
 from torch.utils.data import DataLoader
-from training_loop import Train
+from training_loop import Train, compile_available
     
 def fit(train_dataset, validation_dataset, batch_size,
         model, loss_fct, optimizer, scheduler,
         epochs, patience,
         no_of_classes, labels_of_normal_classes,
-        train_sampler=None):
+        train_sampler=None, accum_steps=1):
     
     '''
     ARGUMENTS: 
@@ -23,6 +24,9 @@ def fit(train_dataset, validation_dataset, batch_size,
             - model: custom written model instance as per 'models' folder
             - loss_fct: The loss function. A torch.nn instance
             - optimizer: The algorithm to update weights. A torch.optim instance
+                         On gpu, Adam, AdamW and SGD may be constructed with fused=True 
+                         (ex. torch.optim.AdamW(params, lr, fused=True)) so that each step runs as a single fused kernel.
+                         The gradients are reset with zero_grad(set_to_none=True) during training.
             - scheduler: Use to change learning rate per epochs. A torch.optim instance
      
      --> 'epochs': max number of training epochs
@@ -34,6 +38,10 @@ def fit(train_dataset, validation_dataset, batch_size,
                                       The ImageFolder method and or CustomDataset class assigns integers automatically to the classes
                                       In order to verify the the class name-label assignment created by the Dataloader you may type
                                       "print(train_dataset.class_to_idx)"
+     
+     --> 'accum_steps': Default is 1. No of batches over which the gradients are accumulated before each optimizer step,
+                        i.e. the effective batch size is accum_steps*batch_size. If the model is wrapped in DistributedDataParallel,
+                        the gradients are all-reduced only once per optimizer step (see remark 13 of training_loop_remarks.md)
             
     OUTPUTS:
     
@@ -42,18 +50,28 @@ def fit(train_dataset, validation_dataset, batch_size,
     '''
     
     # Dataloaders for training and validation datasetss
-    if train_sampler==None:
-        train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, shuffle=True, num_workers=2)
+    # page-locked (pinned) batches allow the non_blocking host to gpu copies of training_loop.py to run asynchronously
+    pin_memory = torch.cuda.is_available()
+    # when training_loop.py compiles the model, the last incomplete training batch is dropped so that all training batches 
+    # have the same shape, which lets the compiled model replay the same CUDA graph on every step instead of recording a new one
+    drop_last = compile_available()
+    if train_sampler is None:
+        train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, shuffle=True, num_workers=2,
+                                  pin_memory=pin_memory, persistent_workers=True, drop_last=drop_last)
     else:
         train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, 
-                                  shuffle=False, num_workers=2, sampler=train_sampler)
-    val_loader = DataLoader(dataset=validation_dataset, batch_size=batch_size, shuffle=True, num_workers=2)
+                                  shuffle=False, num_workers=2, sampler=train_sampler,
+                                  pin_memory=pin_memory, persistent_workers=True, drop_last=drop_last)
+    val_loader = DataLoader(dataset=validation_dataset, batch_size=batch_size, shuffle=True, num_workers=2,
+                            pin_memory=pin_memory, persistent_workers=True)
+    assert len(train_loader) > 0, 'the training DataLoader yields no batches (fewer than batch_size samples with drop_last=True)'
     
     # training_loop.py instance
     instance = Train(model.model, loss_fct, optimizer, scheduler,
                   train_loader, val_loader, 
                   epochs, patience,
-                  no_of_classes, labels_of_normal_classes)
+                  no_of_classes, labels_of_normal_classes,
+                  accum_steps=accum_steps)
 
     training_dict, validation_dict = instance.training()
 
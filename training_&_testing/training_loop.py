@@ -1,13 +1,58 @@
 import os
+import contextlib
+import numpy as np
 import torch
-from copy import deepcopy
+
+class _Prefetcher():
+    
+    '''
+    Iterates over a DataLoader and copies the next batch to the gpu on a side cuda stream,
+    so that the host to gpu transfer of batch i+1 overlaps with the computations on batch i.
+    '''
+    
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.stream = torch.cuda.Stream(device=self.device)
+        self.preload()
+        return self
+    
+    def preload(self):
+        try:
+            images, labels = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_batch = (images.to(self.device, non_blocking=True), labels.to(self.device, non_blocking=True))
+        
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+        # wait for the copy of the batch, and mark its memory as used by the main stream so that it is not reused too early
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        images, labels = self.next_batch
+        images.record_stream(current_stream)
+        labels.record_stream(current_stream)
+        self.preload()
+        return images, labels
+
+def compile_available():
+    
+    # whether Train compiles the model (gpu and torch>=2.0); fit() of train_model.py uses it to keep the training batch shape fixed
+    return torch.cuda.is_available() and hasattr(torch, 'compile')
 
 class Train():
     
     def __init__(self, model, loss_fct, optimizer, scheduler, 
                  train_loader, validation_loader, 
                  epochs, patience,
-                 no_of_classes, labels_of_normal_classes):
+                 no_of_classes, labels_of_normal_classes,
+                 accum_steps=1, keep_checkpoints=1):
         
         # set device attribute
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -24,34 +69,78 @@ class Train():
         self.patience = patience                                  # epochs to wait until EarlyStopping condition is satisfied
         self.no_of_classes = no_of_classes                        # integer
         self.labels_of_normal_classes = labels_of_normal_classes  # should be either None or a list of integers
+        self.accum_steps = accum_steps                            # no of batches to accumulate gradients over before each optimizer step
+        self.keep_checkpoints = keep_checkpoints                  # no of most recent best model .pt files kept on disk
+        self._has_scheduler = self.scheduler is not None          # fixed for the whole run
+        assert self.accum_steps >= 1, 'accum_steps should be a positive integer'
+        assert self.keep_checkpoints >= 1, 'keep_checkpoints should be a positive integer'
+        
+        # indices of the disease (i.e. not normal) classes, whose avg recall is monitored by the Early Stopping callback
+        normal_classes = frozenset(self.labels_of_normal_classes or [])
+        assert all(x in range(self.no_of_classes) for x in normal_classes)
+        self._disease_idx = [i for i in range(self.no_of_classes) if i not in normal_classes]
+        assert len(self._disease_idx) > 0, 'at least one class should not be listed in labels_of_normal_classes'
+        
+        # epoch confusion matrix (rows: real classes, columns: predicted classes), allocated once and reset in place every epoch
+        self.confusion = torch.zeros(self.no_of_classes, self.no_of_classes, dtype=torch.long, device=self.device)
         
-        self.model.to(self.device)
+        # cuDNN autotunes the conv algorithms for the (fixed) input shape of the loaders
+        # and the conv weights are stored in channels_last (NHWC) layout, which tensor-core conv kernels run on without transposes
+        torch.backends.cudnn.benchmark = True
+        self.model.to(self.device, memory_format=torch.channels_last)
+        
+        # mixed precision (gpu only): bfloat16 on Ampere or newer gpus (compute capability >= 8.0), otherwise float16 along with loss scaling
+        # (older gpus such as T4 or V100 report bfloat16 as supported, but only emulate it without tensor cores)
+        self.amp_enabled = self.device.type == 'cuda'
+        self.amp_dtype = torch.bfloat16 if self.amp_enabled and torch.cuda.get_device_capability(self.device)[0] >= 8 else torch.float16
+        scaler_enabled = self.amp_enabled and self.amp_dtype == torch.float16
+        if hasattr(torch.amp, 'GradScaler'):   # torch>=2.3; torch.cuda.amp.GradScaler is deprecated from then on
+            self.scaler = torch.amp.GradScaler(self.device.type, enabled=scaler_enabled)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=scaler_enabled)
+        
+        # compile the model (torch>=2.0, gpu only) so that its forward/backward kernels are fused
+        # the uncompiled module is kept in self._orig_model; its weights are the ones copied and saved by the Early Stopping callback
+        self._orig_model = self.model
+        self._compiled = False
+        # compilation itself is lazy and happens on the first forward pass, see the forward method for the fallback
+        if compile_available():
+            self.model = torch.compile(self.model, mode="reduce-overhead", dynamic=False)
+            self._compiled = True
+        # marks the start of each iteration for the CUDA graphs recorded by 'reduce-overhead' (torch>=2.1 only)
+        self._mark_step = getattr(getattr(torch, 'compiler', None), 'cudagraph_mark_step_begin', None)
         
     #------------------------------------------------------------------------------------------------------
     
     def training(self):
         
-        # initialize empty dictionaries to save loss and metrics history PER EPOCH
-        self.training_history = {'loss':[], 'accuracy':[], 'avg_recall':[], 'avg_precision':[], 'avg_f1':[], 
-            'recall_per_class':[[] for _ in range(self.no_of_classes)], 
-            'precision_per_class':[[] for _ in range(self.no_of_classes)], 
-            'f1_per_class':[[] for _ in range(self.no_of_classes)]}
-        self.validation_history = {'loss':[], 'accuracy':[], 'avg_recall':[], 'avg_precision':[], 'avg_f1':[], 
-            'recall_per_class':[[] for _ in range(self.no_of_classes)], 
-            'precision_per_class':[[] for _ in range(self.no_of_classes)],
-            'f1_per_class':[[] for _ in range(self.no_of_classes)]}
+        # DO NOT call torch.cuda.empty_cache() inside the epoch loop: it releases the cached blocks of the cuda caching allocator,
+        # which then have to be re-allocated (cudaMalloc) on the next steps, and adds milliseconds per call (see remark 14)
+        
+        # initialize dictionaries to save loss and metrics history PER EPOCH
+        # each value is a numpy array with one row per epoch, allocated for the max no of epochs and truncated to the epochs run at the end
+        E, C = self.epochs, self.no_of_classes
+        self.training_history = {'loss':np.zeros(E), 'accuracy':np.zeros(E), 'avg_recall':np.zeros(E), 'avg_precision':np.zeros(E), 'avg_f1':np.zeros(E), 
+            'recall_per_class':np.zeros((E, C)), 
+            'precision_per_class':np.zeros((E, C)), 
+            'f1_per_class':np.zeros((E, C))}
+        self.validation_history = {'loss':np.zeros(E), 'accuracy':np.zeros(E), 'avg_recall':np.zeros(E), 'avg_precision':np.zeros(E), 'avg_f1':np.zeros(E), 
+            'recall_per_class':np.zeros((E, C)), 
+            'precision_per_class':np.zeros((E, C)),
+            'f1_per_class':np.zeros((E, C))}
+        self.epoch = -1                       # index of the current epoch, i.e. the history row being written
 
         # below block is used in the Early Stopping section of the loop
         self.threshold_val_loss    = 10e+5
         self.threshold_avg_recall  = 0
-        self.best_model            = deepcopy(self.model)
         self.unchanged_epochs      = 0
         self.early_stopping_checkpoints = []  # to keep track of the improved epochs
         
         print('Starting training..')
         
         for e in range(0, self.epochs):
-
+            
+            self.epoch = e
             print('-'*35)
             print(f'Epoch {e + 1}/{self.epochs}')
 
@@ -84,9 +173,14 @@ class Train():
                 break
             
             #-------Update_Scheduler_for_next_epoch-------------
-            if self.scheduler != None:
+            if self._has_scheduler:
                 self.scheduler.step()    
             
+        # keep only the rows of the epochs that were run
+        for history in (self.training_history, self.validation_history):
+            for key in history:
+                history[key] = history[key][:self.epoch + 1]
+        
         print('Training complete !')
         return self.training_history, self.validation_history
     
@@ -94,142 +188,188 @@ class Train():
     
     def train_epoch(self):
         
-        train_loss = 0
-        self.target_true = [0 for _ in range(self.no_of_classes)]; 
-        self.predicted_true = [0 for _ in range(self.no_of_classes)]; 
-        self.correct_true = [0 for _ in range(self.no_of_classes)]
+        train_loss = torch.zeros((), device=self.device)   # running sum of batch losses, kept on device
+        self.confusion.zero_()
         
-        if self.scheduler != None:
+        if self._has_scheduler:
             print('  lr value {}'.format(self.optimizer.param_groups[0]['lr']))
         
-        for train_step, (images, labels) in enumerate(self.train_loader): 
-            images, labels = images.to(self.device), labels.to(self.device)  #send data to device 
+        K = self.accum_steps
+        is_ddp = isinstance(self._orig_model, torch.nn.parallel.DistributedDataParallel)
+        n_total = len(self.train_loader)
+        last_group_start = n_total - n_total % K   # batches after this one form the last, incomplete group (if any)
+        self.optimizer.zero_grad(set_to_none=True)      #reset the parameter gradients (dropped instead of zero-filled)
+        
+        n_batches = 0
+        for images, labels in self.batches(self.train_loader): 
+            n_batches += 1
+            if self._compiled and self._mark_step is not None:
+                self._mark_step()                           #new iteration of the CUDA graphs recorded by 'reduce-overhead'
+            images = images.to(self.device, non_blocking=True)   #send data to device 
+            labels = labels.to(self.device, non_blocking=True)   #(asynchronous copy when loader uses pin_memory=True)
+            if images.ndim == 4:
+                images = images.contiguous(memory_format=torch.channels_last)   #match the model's NHWC layout
     
-            # batch training
-            self.optimizer.zero_grad()                      #zero the parameter gradients
-            outputs = self.model(images)                    #forward
-            loss = self.loss_fct(outputs, labels)           #compute loss
-            loss.backward()                                 #backward
-            self.optimizer.step()                           #optimize
-            train_loss += loss.item()                       #add batch loss to the total epoch train loss
+            # batch training: gradients are accumulated over K batches and the optimizer steps on every K-th batch
+            # and on the last batch of the epoch; the batch losses are divided by the size of their group of batches
+            # with DDP, the gradient all-reduce is skipped (no_sync) on the batches that are not followed by a step
+            update_step = n_batches % K == 0 or n_batches == n_total
+            group_size = K if n_batches <= last_group_start else n_total - last_group_start
+            sync_context = self._orig_model.no_sync() if (is_ddp and not update_step) else contextlib.nullcontext()
+            with sync_context:
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_enabled):
+                    outputs = self.forward(images)          #forward
+                    loss = self.loss_fct(outputs, labels)   #compute loss
+                self.scaler.scale(loss / group_size).backward()   #backward (loss is scaled only in float16 mode)
+            if update_step:
+                self.scaler.step(self.optimizer)            #optimize
+                self.scaler.update()                        #update the loss scale factor
+                self.optimizer.zero_grad(set_to_none=True)  #reset the parameter gradients
+            train_loss += loss.detach()                     #add batch loss to the total epoch train loss
     
             # class metrics - batch level
-            labels_list = torch.Tensor.tolist(labels)
-            _, preds = torch.max(outputs, 1)            
-            preds_list = torch.Tensor.tolist(preds)
-            self.batch_metrics(labels_list, preds_list)
+            preds = outputs.detach().argmax(dim=1)   #predicted classes, kept on device
+            self.batch_metrics(labels, preds)
             
-        # mean epoch train loss
-        train_loss /= (train_step + 1)
+        # mean epoch train loss (single device to host copy per epoch), nan for an empty epoch
+        train_loss = (train_loss / n_batches).item() if n_batches else np.nan
         print(f'  Loss={train_loss:.4f}')
-        self.training_history['loss'].append(train_loss)
+        self.training_history['loss'][self.epoch] = train_loss
      
     #------------------------------------------------------------------------------------------------------   
      
     def validate_epoch(self):
         
-        val_loss = 0
-        self.target_true = [0 for _ in range(self.no_of_classes)]; 
-        self.predicted_true = [0 for _ in range(self.no_of_classes)]; 
-        self.correct_true = [0 for _ in range(self.no_of_classes)]
+        val_loss = torch.zeros((), device=self.device)     # running sum of batch losses, kept on device
+        self.confusion.zero_()
         
-        with torch.no_grad():
-            for val_step, (images, labels) in enumerate(self.validation_loader):
-                images, labels = images.to(self.device), labels.to(self.device)   #send data to device
+        with torch.inference_mode():   # no autograd, view or version-counter tracking (outputs are never used for backward)
+            n_batches = 0
+            for images, labels in self.batches(self.validation_loader):
+                n_batches += 1
+                if self._compiled and self._mark_step is not None:
+                    self._mark_step()
+                images = images.to(self.device, non_blocking=True)   #send data to device
+                labels = labels.to(self.device, non_blocking=True)   #(asynchronous copy when loader uses pin_memory=True)
+                if images.ndim == 4:
+                    images = images.contiguous(memory_format=torch.channels_last)   #match the model's NHWC layout
         
                 # batch validation
-                outputs = self.model(images)             #forward
-                loss = self.loss_fct(outputs, labels)    #compute loss
-                val_loss += loss.item()                  #add batch loss to the total epoch validation loss
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_enabled):
+                    outputs = self.forward(images)        #forward
+                    loss = self.loss_fct(outputs, labels) #compute loss
+                val_loss += loss.detach()                #add batch loss to the total epoch validation loss
         
                 # class metrics
-                labels_list = torch.Tensor.tolist(labels)
-                _, preds = torch.max(outputs, 1)
-                preds_list = torch.Tensor.tolist(preds)
-                self.batch_metrics(labels_list, preds_list)
+                preds = outputs.argmax(dim=1)            #predicted classes, kept on device
+                self.batch_metrics(labels, preds)
             
-        # mean epoch validation loss
-        val_loss /= (val_step + 1)
+        # mean epoch validation loss (single device to host copy per epoch), nan for an empty epoch
+        # (nan <= threshold is False, so the Early Stopping callback never counts an empty epoch as an improvement)
+        val_loss = (val_loss / n_batches).item() if n_batches else np.nan
         print(f'  Loss={val_loss:.4f}')
-        self.validation_history['loss'].append(val_loss)
+        self.validation_history['loss'][self.epoch] = val_loss
 
     #------------------------------------------------------------------------------------------------------
     
-    def batch_metrics(self, labels_list, preds_list):
+    def batches(self, loader):
+        
+        # on gpu the batches are copied ahead of time on a side stream (see _Prefetcher)
+        # in that case the .to(self.device) calls of the training/validation loops do nothing
+        return _Prefetcher(loader, self.device) if self.device.type == 'cuda' else loader
+        
+    #------------------------------------------------------------------------------------------------------
+    
+    def forward(self, images):
+        
+        # torch.compile builds its kernels on the first calls of the compiled model (one per train/eval mode and input shape),
+        # so compiler backend errors (ex. gpu not supported by Triton, missing compiler toolchain) are raised here;
+        # in that case training continues with the uncompiled model, while any other error (ex. in the model code) is re-raised
+        if self._compiled:
+            try:
+                return self.model(images)
+            except torch._dynamo.exc.BackendCompilerFailed as error:
+                print(f'  torch.compile failed, falling back to the uncompiled model ({error})')
+                self.model = self._orig_model
+                self._compiled = False
+        return self.model(images)
+        
+    #------------------------------------------------------------------------------------------------------
+    
+    def batch_metrics(self, labels, preds):
 
-        for clas in range(self.no_of_classes):
-            # no of real class points
-            self.target_true[clas] += len([i for i in labels_list if i==clas])
-            # no of predicted class points
-            self.predicted_true[clas] += len([i for i in preds_list if i==clas]) 
-            # no of correctly predicted class points
-            self.correct_true[clas] += len([i for i, (x, y) in enumerate(zip(labels_list, preds_list)) if x == y and x == clas])
+        # confusion matrix update on device: rows are real classes, columns are predicted classes
+        # (real class, predicted class) pairs are encoded as labels*C + preds and scattered into the flattened matrix with index_add_,
+        # which, unlike torch.bincount, does not synchronize with the cpu on gpu (bincount reads its max input back to size the output)
+        C = self.no_of_classes
+        self.confusion.view(-1).index_add_(0, labels * C + preds, torch.ones_like(labels, dtype=self.confusion.dtype))
             
     #------------------------------------------------------------------------------------------------------
     
     def epoch_metrics(self, dictionary):
     
-        # CLASS METRICS on epoch level
-        recalls = [0 for _ in range(self.no_of_classes)]; 
-        precisions = [0 for _ in range(self.no_of_classes)]; 
-        f1_scores = [0 for _ in range(self.no_of_classes)]
+        # per class counts derived from the epoch confusion matrix
+        target_true    = self.confusion.sum(1).double()   # no of real class points
+        predicted_true = self.confusion.sum(0).double()   # no of predicted class points
+        correct_true   = self.confusion.diag().double()   # no of correctly predicted class points
         
-        for clas in range(self.no_of_classes):
-            
-            recalls[clas] = round(self.correct_true[clas] / self.target_true[clas], 2) if self.target_true[clas] else 0
-            dictionary['recall_per_class'][clas].append(recalls[clas])
-            
-            precisions[clas] = round(self.correct_true[clas] / self.predicted_true[clas], 2) if self.predicted_true[clas] else 0
-            dictionary['precision_per_class'][clas].append(precisions[clas])
-            
-            denominator = precisions[clas] + recalls[clas]
-            f1_scores[clas] = 2 * round(precisions[clas] * recalls[clas] / denominator, 2) if denominator else 0
-            dictionary['f1_per_class'][clas].append(f1_scores[clas])
-    
-        # MACRO AVG METRICS on epoch level
-        accuracy = round(sum(self.correct_true)/sum(self.target_true), 2)
-        dictionary['accuracy'].append(accuracy)
+        # CLASS METRICS on epoch level, computed for all classes at once (metric is 0 when its denominator is 0)
+        # clamp(min=1) only affects zero counts, in which case correct_true is 0 as well
+        recalls = correct_true / target_true.clamp(min=1)
+        precisions = correct_true / predicted_true.clamp(min=1)
+        denominator = precisions + recalls
+        f1_scores = torch.where(denominator > 0, 2 * precisions * recalls / denominator, torch.zeros_like(denominator))
+        total = target_true.sum()
+        accuracy = correct_true.sum() / total.clamp(min=1)
         
-        recall = round(sum(recalls)/len(recalls), 2)
-        dictionary['avg_recall'].append(recall)
+        # single device to host copy; the values are stored unrounded and only rounded when printed
+        metrics = torch.cat([recalls, precisions, f1_scores, accuracy.view(1), total.view(1)]).cpu().numpy()
+        # an empty epoch (no batches) has nothing to measure: nan is stored so that it is not mistaken for a real value
+        if metrics[-1] == 0:
+            metrics[:] = np.nan
+        C = self.no_of_classes
+        recalls, precisions, f1_scores, accuracy = metrics[:C], metrics[C:2*C], metrics[2*C:3*C], metrics[3*C]
         
-        precision = round(sum(precisions)/len(precisions), 2)
-        dictionary['avg_precision'].append(precision)
-            
-        f1_score = round(sum(f1_scores)/len(f1_scores), 2)
-        dictionary['avg_f1'].append(f1_score)
+        dictionary['recall_per_class'][self.epoch] = recalls
+        dictionary['precision_per_class'][self.epoch] = precisions
+        dictionary['f1_per_class'][self.epoch] = f1_scores
+    
+        # MACRO AVG METRICS on epoch level
+        dictionary['accuracy'][self.epoch] = accuracy
+        dictionary['avg_recall'][self.epoch] = recalls.mean()
+        dictionary['avg_precision'][self.epoch] = precisions.mean()
+        dictionary['avg_f1'][self.epoch] = f1_scores.mean()
     
-        print(f'  Accuracy={accuracy} - Recall per class={recalls}')
+        recalls_str = ', '.join(f'{r:.2f}' for r in recalls)
+        print(f'  Accuracy={accuracy:.2f} - Recall per class=[{recalls_str}]')
         
     #------------------------------------------------------------------------------------------------------
     def early_stopping_check(self):
         
         #current epoch validation loss and avg recall of all disease classes 
-        epoch_val_loss = self.validation_history['loss'][-1]
-        if self.labels_of_normal_classes != None:
-            epoch_val_avg_recall = sum([j[-1] for (i, j) in enumerate(self.validation_history['recall_per_class']) if i not in self.labels_of_normal_classes]) \
-                                    / (self.no_of_classes - len(self.labels_of_normal_classes))
-        else:
-            epoch_val_avg_recall = sum([j[-1] for (i, j) in enumerate(self.validation_history['recall_per_class'])]) \
-                                    / (self.no_of_classes)
+        epoch_val_loss = self.validation_history['loss'][self.epoch]
+        epoch_val_avg_recall = self.validation_history['recall_per_class'][self.epoch, self._disease_idx].mean()
         
         # αν το loss πεφτει και αν τα unhealthy class recalls αυξηθηκαν on avg όρισε νέο best_model και ανανεώσε τα thresholds
         if (epoch_val_loss <= self.threshold_val_loss) and (self.threshold_avg_recall <= epoch_val_avg_recall):           
             
-            current_epoch = len(self.validation_history['loss'])
+            current_epoch = self.epoch + 1
             self.early_stopping_checkpoints.append(current_epoch)  
             
-            del self.best_model                                  # διεγραψε το παλιο best model attribute από τη μνήνη
-            
-            self.best_model = deepcopy(self.model)               # θεσε ως best το νεο
-            
             self.unchanged_epochs = 0                            # epoch counter ξανα στο 0
             self.threshold_val_loss  = epoch_val_loss            # θεσε το νέο loss ως μέγιστο target
             self.threshold_avg_recall = epoch_val_avg_recall     # θεσε το νέο avg recall ως ελάχιστο target
             
-            if (current_epoch>=2):
-                os.remove(f'model_epoch{self.early_stopping_checkpoints[-2]}.pt')      # διεγραψε το παλιο μοντέλο από το φάκελο 
-            torch.save(self.best_model, f'model_epoch{current_epoch}.pt')
+            # θεσε ως best το νεο: αντίγραφο του state_dict στη cpu, που γράφεται σε προσωρινό αρχείο και μετονομάζεται (os.replace)
+            # ώστε ένα crash κατά την αποθήκευση να μην αφήσει το φάκελο χωρίς μοντέλο
+            best_state_dict = {k: v.detach().to('cpu', copy=True) for k, v in self._orig_model.state_dict().items()}
+            path = f'model_epoch{current_epoch}.pt'
+            torch.save(best_state_dict, path + '.tmp', _use_new_zipfile_serialization=True)
+            os.replace(path + '.tmp', path)
+            
+            # κράτα τα keep_checkpoints πιο πρόσφατα μοντέλα και διεγραψε το παλιότερο από το φάκελο
+            if len(self.early_stopping_checkpoints) > self.keep_checkpoints:
+                os.remove(f'model_epoch{self.early_stopping_checkpoints[-(self.keep_checkpoints + 1)]}.pt')
             
             print('->New model saved!')
             